@@ -1,14 +1,15 @@
 # backend/chat_history.py
 
 import os
-import uuid
 import time
-from typing import List, Dict, Any
-from backend.qdrant_client import qdrant_client, CHAT_HISTORY_COLLECTION
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+from backend.qdrant_client import qdrant_client, CHAT_HISTORY_COLLECTION, get_session_filter, content_point_id
 
 # Try different import approaches for qdrant-client compatibility
 try:
-    from qdrant_client.models import PointStruct, Filter, FieldCondition, MatchValue, OrderBy
+    from qdrant_client.models import PointStruct, Filter, FieldCondition, OrderBy, Range
     # Try importing Order from different locations
     try:
         from qdrant_client.models import Order
@@ -23,7 +24,7 @@ try:
 except ImportError as e:
     print(f"Import error: {e}")
     # Fallback for older versions
-    from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, OrderBy
+    from qdrant_client.http.models import PointStruct, Filter, FieldCondition, OrderBy, Range
     try:
         from qdrant_client.http.models import Order
     except ImportError:
@@ -32,12 +33,64 @@ except ImportError as e:
             ASC = "asc"
             DESC = "desc"
 
+# Highest turn_number stored per session by this process. Lets retrieve_chat_context fetch
+# only the last few turns with a range filter instead of ordering the whole session.
+# Bounded LRU: abandoned sessions are evicted instead of accumulating for the server's lifetime.
+# Other workers may have stored newer turns, so the value is only a hint (see retrieve_chat_context).
+TURN_CACHE_MAX_SESSIONS = 2048
+_last_turn_numbers: "OrderedDict[str, int]" = OrderedDict()
+_turn_cache_lock = threading.Lock()
+
+def _remember_turn_number(session_id: str, turn_number: int):
+    """
+    Records the highest turn number stored for a session, evicting the least recently used session.
+    """
+    with _turn_cache_lock:
+        _last_turn_numbers[session_id] = max(turn_number, _last_turn_numbers.get(session_id, 0))
+        _last_turn_numbers.move_to_end(session_id)
+        while len(_last_turn_numbers) > TURN_CACHE_MAX_SESSIONS:
+            _last_turn_numbers.popitem(last=False)
+
+def _cached_turn_number(session_id: str) -> Optional[int]:
+    """
+    Returns the cached last turn number for a session, or None if it isn't cached.
+    """
+    with _turn_cache_lock:
+        if session_id not in _last_turn_numbers:
+            return None
+        _last_turn_numbers.move_to_end(session_id)
+        return _last_turn_numbers[session_id]
+
+def clear_turn_cache(session_id: str):
+    """
+    Forgets the cached last turn number for a session (e.g. when the session is deleted).
+    """
+    with _turn_cache_lock:
+        _last_turn_numbers.pop(session_id, None)
+
+def next_turn_number(session_id: str) -> int:
+    """
+    Returns the turn number for the next user/assistant exchange in a session.
+    Always counts the session's stored messages (two per turn) using the session_id payload
+    index; the per-process cache could be stale when several workers serve the same session.
+    """
+    try:
+        message_count = qdrant_client.count(
+            collection_name=CHAT_HISTORY_COLLECTION,
+            count_filter=get_session_filter(session_id),
+            exact=True  # Cheap with the keyword index, and an estimate could repeat turn numbers
+        ).count
+    except Exception as e:
+        print(f"Error counting chat turns for session {session_id}: {e}")
+        message_count = 0
+    return message_count // 2 + 1
+
 def store_chat_turn(session_id: str, role: str, message: str, turn_number: int):
     """
     Stores a single turn of chat (user or assistant message) in Qdrant.
     """
     try:
-        point_id = str(uuid.uuid4())
+        point_id = content_point_id(session_id, role, str(turn_number), message)
         timestamp = str(int(time.time()))
 
         payload = {
@@ -52,69 +105,102 @@ def store_chat_turn(session_id: str, role: str, message: str, turn_number: int):
             collection_name=CHAT_HISTORY_COLLECTION,
             wait=True,
             points=[
-                PointStruct(id=point_id, vector=[0.0]*384, payload=payload)
+                PointStruct(id=point_id, vector={}, payload=payload)  # Payload-only point
             ]
         )
+        _remember_turn_number(session_id, turn_number)
     except Exception as e:
         print(f"Error storing chat turn for session {session_id}: {e}")
 
-def retrieve_chat_context(session_id: str, current_question: str, max_turns: int = 4) -> str:
+def _scroll_latest_turns(session_filter: Filter, limit: int):
     """
-    Retrieves the last N turns of chat history for a given session,
-    excluding the current question.
-    Returns a formatted string suitable for LLM context.
+    Scrolls a session's chat turns ordered by turn_number, newest first.
     """
+    # Use scroll with order_by - try both approaches for compatibility
     try:
-        session_filter = Filter(
-            must=[
-                FieldCondition(
-                    key="session_id",
-                    match=MatchValue(value=session_id)
-                )
-            ]
+        scroll_result, _ = qdrant_client.scroll(
+            collection_name=CHAT_HISTORY_COLLECTION,
+            scroll_filter=session_filter,
+            limit=limit,
+            offset=0,
+            with_payload=True,
+            with_vectors=False,
+            order_by=OrderBy(key="turn_number", direction=Order.DESC)
         )
-
-        # Use scroll with order_by - try both approaches for compatibility
+    except Exception:
+        # Fallback for older API versions
         try:
             scroll_result, _ = qdrant_client.scroll(
                 collection_name=CHAT_HISTORY_COLLECTION,
                 scroll_filter=session_filter,
-                limit=max_turns * 2,
+                limit=limit,
                 offset=0,
                 with_payload=True,
                 with_vectors=False,
-                order_by=OrderBy(key="turn_number", direction=Order.DESC)
+                order_by=OrderBy(key="turn_number", order=Order.DESC)
             )
         except Exception:
-            # Fallback for older API versions
-            try:
-                scroll_result, _ = qdrant_client.scroll(
-                    collection_name=CHAT_HISTORY_COLLECTION,
-                    scroll_filter=session_filter,
-                    limit=max_turns * 2,
-                    offset=0,
-                    with_payload=True,
-                    with_vectors=False,
-                    order_by=OrderBy(key="turn_number", order=Order.DESC)
-                )
-            except Exception:
-                # Final fallback without ordering
-                scroll_result, _ = qdrant_client.scroll(
-                    collection_name=CHAT_HISTORY_COLLECTION,
-                    scroll_filter=session_filter,
-                    limit=max_turns * 2,
-                    offset=0,
-                    with_payload=True,
-                    with_vectors=False
-                )
+            # Final fallback without ordering
+            scroll_result, _ = qdrant_client.scroll(
+                collection_name=CHAT_HISTORY_COLLECTION,
+                scroll_filter=session_filter,
+                limit=limit,
+                offset=0,
+                with_payload=True,
+                with_vectors=False
+            )
+    return scroll_result
+
+def retrieve_chat_context(session_id: str, current_question: str, max_turns: int = 4) -> str:
+    """
+    Retrieves the last N turns of chat history for a given session,
+    excluding the current question.
+    Returns a formatted string suitable for LLM context.
+    """
+    try:
+        session_filter = get_session_filter(session_id)
+
+        scroll_result = None
+        last_turn_number = _cached_turn_number(session_id)
+        if last_turn_number is not None:
+            # Keyset lookup: only the last max_turns turns should match, so no server-side ordering
+            # is needed. Ask for one extra point to detect a stale cache.
+            recent_turns_filter = Filter(
+                must=session_filter.must + [
+                    FieldCondition(
+                        key="turn_number",
+                        range=Range(gte=last_turn_number - max_turns + 1)
+                    )
+                ]
+            )
+            recent_result, _ = qdrant_client.scroll(
+                collection_name=CHAT_HISTORY_COLLECTION,
+                scroll_filter=recent_turns_filter,
+                limit=max_turns * 2 + 1,
+                with_payload=True,
+                with_vectors=False
+            )
+            # The cache is stale if it is too low (more matches than fit: another worker stored newer
+            # turns, and an unordered scroll could drop them) or too high (the session was ended or
+            # wiped through another worker, so the cached turn is missing). Only trust a range
+            # result that fits and contains the cached turn.
+            if 0 < len(recent_result) <= max_turns * 2 and max(
+                (record.payload or {}).get("turn_number", 0) for record in recent_result
+            ) >= last_turn_number:
+                scroll_result = recent_result
+        if scroll_result is None:
+            # Turn number unknown or stale in this process: order the session via the turn_number index
+            if last_turn_number is not None:
+                clear_turn_cache(session_id)  # Reseeded by the next stored turn
+            scroll_result = _scroll_latest_turns(session_filter, limit=max_turns * 2)
 
         chat_turns = []
         for record in scroll_result:
             if record.payload:
                 chat_turns.append(record.payload)
         
-        # Sort manually to ensure correct order
-        chat_turns.sort(key=lambda x: x.get("turn_number", 0))
+        # Sort manually to ensure correct order (the user message comes before the reply in a turn)
+        chat_turns.sort(key=lambda x: (x.get("turn_number", 0), x.get("role") != "user"))
 
         formatted_history = []
         for turn in chat_turns:
@@ -1,14 +1,22 @@
 from chonkie import RecursiveChunker
+from functools import lru_cache
 from typing import List
 
-def chunk_text(text: str, chunk_size: int = 200, overlap: int = 50) -> List[str]:
+@lru_cache(maxsize=8)
+def _get_chunker(chunk_size: int) -> RecursiveChunker:
     """
-    Chunk text using Chonkie RecursiveChunker.
+    Builds a Chonkie RecursiveChunker once per chunk size and reuses it across calls.
     """
-    chunker = RecursiveChunker(
+    return RecursiveChunker(
         tokenizer_or_token_counter="word",
         chunk_size=chunk_size,
         min_characters_per_chunk=10
     )
+
+def chunk_text(text: str, chunk_size: int = 200, overlap: int = 50) -> List[str]:
+    """
+    Chunk text using Chonkie RecursiveChunker.
+    """
+    chunker = _get_chunker(chunk_size)
     chunks = chunker(text)
     return [chunk.text for chunk in chunks]
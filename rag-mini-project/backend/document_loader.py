@@ -3,16 +3,25 @@ import fitz  # PyMuPDF for PDF
 from docx import Document as DocxDocument # Aliased to avoid name conflict with our Document class
 import openpyxl
 import csv
-import json
+# orjson (Rust) parses JSON several times faster than the stdlib; fall back if it's missing
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 from bs4 import BeautifulSoup
 from pydantic import BaseModel, Field
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterable, Iterator
 from pathlib import Path
+from io import BytesIO, StringIO
 import uuid # Essential for generating unique IDs
 
 # Import your chunker utility
 from backend.chunker import chunk_text
 
+# Plain-text extraction flags for PyMuPDF: keep whitespace, clip to the page and join
+# words hyphenated across line breaks. Images and span details are never built.
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP | fitz.TEXT_DEHYPHENATE
+
 # --- Define the Document class ---
 # This Pydantic model defines the structure for each processed document chunk.
 class Document(BaseModel):
@@ -20,7 +29,46 @@ class Document(BaseModel):
     metadata: Dict[str, Any] = Field(default_factory=dict) # Metadata like source, page number
     chunk_id: str = Field(default_factory=lambda: str(uuid.uuid4())) # Unique ID for this specific chunk
 
+# Tabular files (XLSX/CSV) are split into text segments of roughly this many words before
+# chunking, so a large spreadsheet is never held as one giant string.
+ROW_SEGMENT_WORDS = 2000
+
 # --- Document Loading and Chunking Functions ---
+def _segment_rows(rows: Iterable[str], header: str = "", max_words: int = ROW_SEGMENT_WORDS) -> Iterator[str]:
+    """
+    Groups an iterable of row strings into newline-joined text segments of about
+    max_words words each. The optional header is repeated at the top of every segment.
+    Rows are consumed lazily and segments without any text are skipped.
+    """
+    buffer = []
+    word_count = 0
+    for row in rows:
+        buffer.append(row)
+        word_count += len(row.split())
+        if word_count >= max_words:
+            text = "\n".join(buffer)
+            if text.strip():
+                yield f"{header}\n{text}" if header else text
+            buffer = []
+            word_count = 0
+    text = "\n".join(buffer)
+    if text.strip():
+        yield f"{header}\n{text}" if header else text
+
+def _flatten_json(value: Any, path: str, out: StringIO):
+    """
+    Walks a parsed JSON value and writes one "path: value" line per string, number or
+    boolean leaf to out (e.g. "authors[0].name: Mario"). Nulls are skipped.
+    """
+    if isinstance(value, dict):
+        for key, child in value.items():
+            _flatten_json(child, f"{path}.{key}" if path else str(key), out)
+    elif isinstance(value, list):
+        for index, child in enumerate(value):
+            _flatten_json(child, f"{path}[{index}]", out)
+    elif value is not None:
+        out.write(f"{path}: {value}\n" if path else f"{value}\n")
+
 def extract_text(file_path: Path, content: bytes) -> List[Document]:
     """
     Extracts raw text from various document types, then processes this text
@@ -40,22 +88,21 @@ def extract_text(file_path: Path, content: bytes) -> List[Document]:
     try:
         # --- PDF Handling ---
         if file_type == "pdf":
-            pdf_document = fitz.open(stream=content, filetype="pdf")
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document.load_page(page_num)
-                text = page.get_text()
-                if text.strip():
-                    raw_texts_with_metadata.append(
-                        {
-                            "text": text,
-                            "metadata": {
-                                "source": filename,
-                                "page_number": page_num + 1,
-                                "file_type": "pdf"
+            # The context manager closes the native MuPDF handle even if extraction fails
+            with fitz.open(stream=content, filetype="pdf") as pdf_document:
+                for page_num, page in enumerate(pdf_document):
+                    text = page.get_text("text", flags=PDF_TEXT_FLAGS)
+                    if text.strip():
+                        raw_texts_with_metadata.append(
+                            {
+                                "text": text,
+                                "metadata": {
+                                    "source": filename,
+                                    "page_number": page_num + 1,
+                                    "file_type": "pdf"
+                                }
                             }
-                        }
-                    )
-            pdf_document.close()
+                        )
 
         # --- Text File Handling ---
         elif file_type == "txt":
@@ -73,12 +120,9 @@ def extract_text(file_path: Path, content: bytes) -> List[Document]:
 
         # --- DOCX (Word) Handling ---
         elif file_type == "docx":
-            from io import BytesIO
+            # BytesIO shares the uploaded bytes' buffer (no copy) since nothing writes to it
             doc = DocxDocument(BytesIO(content))
-            full_text = []
-            for para in doc.paragraphs:
-                full_text.append(para.text)
-            text = "\n".join(full_text)
+            text = "\n".join(para.text for para in doc.paragraphs)
             if text.strip():
                 raw_texts_with_metadata.append(
                     {
@@ -92,36 +136,33 @@ def extract_text(file_path: Path, content: bytes) -> List[Document]:
 
         # --- XLSX (Excel) Handling ---
         elif file_type == "xlsx":
-            from io import BytesIO
-            workbook = openpyxl.load_workbook(BytesIO(content))
-            all_sheets_text = []
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                sheet_text = []
-                for row in sheet.iter_rows():
-                    row_values = [str(cell.value) if cell.value is not None else "" for cell in row]
-                    sheet_text.append("\t".join(row_values))
-                all_sheets_text.append(f"Sheet: {sheet_name}\n" + "\n".join(sheet_text))
-            text = "\n\n".join(all_sheets_text)
-            if text.strip():
-                raw_texts_with_metadata.append(
-                    {
-                        "text": text,
-                        "metadata": {
-                            "source": filename,
-                            "file_type": "xlsx"
-                        }
-                    }
-                )
+            # read_only streams rows instead of building the whole workbook in memory
+            workbook = openpyxl.load_workbook(BytesIO(content), read_only=True, keep_vba=False, data_only=True)
+            try:
+                for sheet in workbook.worksheets:
+                    rows = (
+                        "\t".join("" if value is None else str(value) for value in row)
+                        for row in sheet.iter_rows(values_only=True)
+                    )
+                    for text in _segment_rows(rows, header=f"Sheet: {sheet.title}"):
+                        raw_texts_with_metadata.append(
+                            {
+                                "text": text,
+                                "metadata": {
+                                    "source": filename,
+                                    "file_type": "xlsx"
+                                }
+                            }
+                        )
+            finally:
+                workbook.close()  # Read-only workbooks keep the archive open until closed
 
         # --- CSV Handling ---
         elif file_type == "csv":
-            from io import StringIO
             decoded_content = content.decode('utf-8')
             reader = csv.reader(StringIO(decoded_content))
-            csv_data = [",".join(row) for row in reader]
-            text = "\n".join(csv_data)
-            if text.strip():
+            rows = (",".join(row) for row in reader)
+            for text in _segment_rows(rows):
                 raw_texts_with_metadata.append(
                     {
                         "text": text,
@@ -134,9 +175,11 @@ def extract_text(file_path: Path, content: bytes) -> List[Document]:
 
         # --- JSON Handling ---
         elif file_type == "json":
-            decoded_content = content.decode('utf-8')
-            json_data = json.loads(decoded_content)
-            text = json.dumps(json_data, indent=2) # Pretty-print JSON for readability
+            json_data = json_loads(content)  # orjson parses the UTF-8 bytes directly, no decode needed
+            # Emit only "path: value" lines for leaf values; braces and commas only waste embedding budget
+            sink = StringIO()
+            _flatten_json(json_data, "", sink)
+            text = sink.getvalue()
             if text.strip():
                 raw_texts_with_metadata.append(
                     {
@@ -203,7 +246,7 @@ def extract_text(file_path: Path, content: bytes) -> List[Document]:
                 final_documents.append(
                     Document(
                         text=chunk_content,
-                        metadata=base_metadata.copy() # Use .copy() to prevent modifying shared metadata dicts
+                        metadata=base_metadata # Pydantic validation already gives each Document its own dict
                     )
                 )
 
@@ -1,7 +1,14 @@
 # backend/embed_utils.py
 import os
-import uuid  # Added for generating point IDs
+import math
 import time  # For upload_timestamp
+import platform  # For picking the ONNX build that matches the CPU
+import hashlib  # For persistent embedding cache keys
+import sqlite3  # Persistent embedding cache
+import threading
+import json  # Shared bulk-upload state
+import fcntl  # File lock around the bulk-upload state
+import numpy as np
 
 # Fix cache directory permissions for Hugging Face Spaces
 os.environ["TRANSFORMERS_CACHE"] = "/tmp/transformers_cache_custom"
@@ -10,22 +17,290 @@ os.makedirs(os.environ["TRANSFORMERS_CACHE"], exist_ok=True)
 
 from sentence_transformers import SentenceTransformer
 # Qdrant client models
-from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, Distance, VectorParams, NamedVector, ScrollResult
-from backend.qdrant_client import qdrant_client, KB_COLLECTION  # Import Qdrant client and collection name
+from qdrant_client.http.models import Distance, VectorParams, NamedVector, ScrollResult, ScoredPoint, SearchParams, QuantizationSearchParams, QueryRequest, OptimizersConfigDiff, Batch
+from backend.qdrant_client import qdrant_client, KB_COLLECTION, get_session_filter, content_point_id  # Import Qdrant client and collection name
 from backend.document_loader import Document  # Import the Document class definition
-from typing import List
+from typing import List, Tuple
+from functools import lru_cache
+from contextlib import contextmanager
 
 # === Embedding Model Initialization ===
 # 'all-MiniLM-L6-v2' is a good balance of size and performance for many applications.
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-print("✅ Embedding model loaded: all-MiniLM-L6-v2")
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# The model repo ships ONNX exports with int8 dynamically quantized weights; ONNX Runtime runs
+# them with fused attention and int8 matmuls, which is much faster than PyTorch on CPU.
+def _default_onnx_file() -> str:
+    """
+    Picks the quantized ONNX build for this CPU: NEON on ARM, AVX-512 VNNI int8 dot products
+    when the CPU advertises them, AVX2 otherwise.
+    """
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            if "avx512_vnni" in cpuinfo.read():
+                return "onnx/model_qint8_avx512_vnni.onnx"
+    except OSError:
+        pass  # Not Linux: use the AVX2 build, which runs on any x86-64 CPU from the last decade
+    return "onnx/model_quint8_avx2.onnx"
+
+# Override with EMBEDDING_ONNX_FILE (e.g. "onnx/model.onnx" for the unquantized export)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE") or _default_onnx_file()
+
+try:
+    embedding_model = SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        backend="onnx",
+        model_kwargs={"file_name": EMBEDDING_ONNX_FILE, "provider": "CPUExecutionProvider"},
+    )
+    embedding_model_id = f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_ONNX_FILE}"
+    print(f"✅ Embedding model loaded: {EMBEDDING_MODEL_NAME} (ONNX Runtime, {EMBEDDING_ONNX_FILE})")
+except Exception as e:
+    # Fallback when onnxruntime/optimum are not installed or the ONNX file can't be loaded
+    print(f"⚠️ Could not load ONNX embedding model ({e}); falling back to PyTorch.")
+    import torch
+    torch.set_num_threads(os.cpu_count() or 1)  # Use every core for CPU matmuls
+    embedding_model = SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        device="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    embedding_model_id = f"{EMBEDDING_MODEL_NAME}:pytorch"
+    print(f"✅ Embedding model loaded: {EMBEDDING_MODEL_NAME}")
+
+# Truncate inputs to 256 word pieces; encode() then tokenizes each batch in one padded call and
+# mean-pools + L2-normalizes on the whole batch tensor (the model's Pooling/Normalize modules).
+EMBEDDING_MAX_SEQ_LENGTH = 256
+embedding_model.max_seq_length = EMBEDDING_MAX_SEQ_LENGTH
+
+# Warm up once at import (the model is a module-level singleton) so the first real query
+# doesn't pay for session initialization and allocator growth
+embedding_model.encode(["warmup"], convert_to_numpy=True, show_progress_bar=False)
+
+# Number of texts encoded per forward pass when embedding document chunks
+EMBED_BATCH_SIZE = 64
+
+# Number of points sent per Qdrant upsert request; very large single requests can stall or time out
+UPSERT_BATCH_SIZE = 128
+
+# Uploads with at least this many chunks (several batches) are pushed by parallel worker processes;
+# each worker imports the client and opens its own channel, so smaller uploads stay in-process
+PARALLEL_UPLOAD_MIN_POINTS = 4 * UPSERT_BATCH_SIZE
+MAX_UPLOAD_WORKERS = 8
+
+# Uploads with at least this many chunks pause HNSW indexing until all points are written
+BULK_INDEXING_MIN_POINTS = 500
+DEFAULT_INDEXING_THRESHOLD = 20000  # Qdrant's default indexing_threshold (in KB), used if the current one can't be read
+
+# Search hits only need the chunk text (and source, for debugging); the rest of the payload
+# (metadata, timestamps, ...) is left on the server to keep responses small
+KB_SEARCH_PAYLOAD_FIELDS = ["text", "source"]
+
+# Search the int8-quantized vectors, oversample 2x, then rescore with the original float32 vectors.
+# hnsw_ef is the candidate list size during graph search (higher = better recall, slower).
+KB_SEARCH_PARAMS = SearchParams(
+    hnsw_ef=64,
+    quantization=QuantizationSearchParams(ignore=False, rescore=True, oversampling=2.0)
+)
+
+# === Persistent Query Embedding Cache ===
+# Second cache tier behind the in-memory LRU: query embeddings survive restarts in SQLite,
+# keyed by SHA-256 of model id + text. /tmp is writable on Hugging Face Spaces.
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "/tmp/embed_cache.sqlite3")
+# Rows older than the TTL are ignored and pruned; beyond the row cap the oldest rows are dropped
+EMBED_CACHE_TTL_SECONDS = int(os.getenv("EMBED_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "200000"))
+EMBED_CACHE_PRUNE_EVERY = 1000  # Writes between prunes
+_embed_cache_lock = threading.Lock()
+_embed_cache_writes = 0
+
+def _prune_embed_cache():
+    """Deletes expired rows, then the oldest rows beyond EMBED_CACHE_MAX_ROWS. Caller holds the lock."""
+    _embed_cache_db.execute(
+        "DELETE FROM embed_cache WHERE created < ?",
+        (int(time.time()) - EMBED_CACHE_TTL_SECONDS,)
+    )
+    _embed_cache_db.execute(
+        "DELETE FROM embed_cache WHERE key IN "
+        "(SELECT key FROM embed_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+        (EMBED_CACHE_MAX_ROWS,)
+    )
+    _embed_cache_db.commit()
+
+try:
+    _embed_cache_db = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+    _embed_cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS embed_cache (key BLOB PRIMARY KEY, vec BLOB, created INTEGER NOT NULL)"
+    )
+    _embed_cache_db.execute("CREATE INDEX IF NOT EXISTS embed_cache_created ON embed_cache (created)")
+    _prune_embed_cache()
+except sqlite3.Error as e:
+    print(f"⚠️ Persistent embedding cache disabled ({EMBED_CACHE_PATH}): {e}")
+    _embed_cache_db = None
+
+def _embed_cache_key(text: str) -> bytes:
+    """Cache key for a text under the currently loaded embedding model."""
+    return hashlib.sha256(f"{embedding_model_id}\x00{text}".encode("utf-8")).digest()
+
+def _load_cached_vector(key: bytes):
+    """Returns the cached vector for key, or None if it isn't stored."""
+    if _embed_cache_db is None:
+        return None
+    try:
+        with _embed_cache_lock:
+            row = _embed_cache_db.execute(
+                "SELECT vec FROM embed_cache WHERE key = ? AND created >= ?",
+                (key, int(time.time()) - EMBED_CACHE_TTL_SECONDS)
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"⚠️ Embedding cache read failed: {e}")
+        return None
+    return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+def _save_cached_vector(key: bytes, vector: np.ndarray):
+    """Stores a vector under key as float32 bytes, refreshing its timestamp. Prunes every few writes."""
+    global _embed_cache_writes
+    if _embed_cache_db is None:
+        return
+    try:
+        with _embed_cache_lock:
+            _embed_cache_db.execute(
+                "INSERT OR REPLACE INTO embed_cache (key, vec, created) VALUES (?, ?, ?)",
+                (key, vector.astype(np.float32).tobytes(), int(time.time()))
+            )
+            _embed_cache_db.commit()
+            _embed_cache_writes += 1
+            if _embed_cache_writes % EMBED_CACHE_PRUNE_EVERY == 0:
+                _prune_embed_cache()
+    except sqlite3.Error as e:
+        print(f"⚠️ Embedding cache write failed: {e}")
 
 # === Helper function to get embedding for text ===
+@lru_cache(maxsize=2048)
+def _cached_embedding(normalized_text: str) -> Tuple[float, ...]:
+    """
+    Encodes a whitespace-normalized text; results are memoized in memory and in SQLite
+    so repeated questions skip the model, even across restarts.
+    """
+    key = _embed_cache_key(normalized_text)
+    vector = _load_cached_vector(key)
+    if vector is None:
+        vector = embedding_model.encode(normalized_text, convert_to_numpy=True)
+        _save_cached_vector(key, vector)
+    return tuple(vector.tolist())
+
 def get_embedding(text: str) -> List[float]:
     """
     Generates an embedding (vector representation) for a given text string.
     """
-    return embedding_model.encode(text).tolist()
+    return list(_cached_embedding(" ".join(text.split())))
+
+# === Helper function to get embeddings for many texts at once ===
+def get_embeddings(texts: List[str]) -> np.ndarray:
+    """
+    Generates embeddings for a list of text strings in batches.
+    Returns a 2-D numpy array with one row per input text.
+    """
+    return embedding_model.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False
+    )
+
+# === Indexing Toggle for Bulk Uploads ===
+# indexing_threshold is collection-wide, so bulk uploads in every thread and worker share one pause.
+# Active uploads are tracked by pid in a state file under an exclusive lock: the first to start saves
+# the collection's threshold and pauses indexing, the last to finish restores the saved value.
+BULK_UPLOAD_STATE_PATH = os.getenv("BULK_UPLOAD_STATE", "/tmp/kb_bulk_upload_state.json")
+
+def _set_indexing_threshold(threshold: int):
+    """
+    Sets the KB collection's HNSW indexing threshold (0 disables indexing).
+    """
+    try:
+        qdrant_client.update_collection(
+            collection_name=KB_COLLECTION,
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=threshold)
+        )
+    except Exception as e:
+        print(f"⚠️ Could not set indexing_threshold={threshold} on '{KB_COLLECTION}': {e}")
+
+def _get_indexing_threshold() -> int:
+    """
+    Returns the KB collection's current indexing threshold, or the default if it can't be read.
+    """
+    try:
+        threshold = qdrant_client.get_collection(KB_COLLECTION).config.optimizer_config.indexing_threshold
+    except Exception as e:
+        print(f"⚠️ Could not read indexing_threshold of '{KB_COLLECTION}': {e}")
+        return DEFAULT_INDEXING_THRESHOLD
+    # 0 means indexing was left paused (e.g. the state file was lost), which is never worth restoring
+    return threshold or DEFAULT_INDEXING_THRESHOLD
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+@contextmanager
+def _bulk_upload_state():
+    """
+    Yields the shared bulk-upload state ({"pids": [...], "threshold": ...}) under an exclusive
+    file lock and writes it back afterwards.
+    """
+    with open(BULK_UPLOAD_STATE_PATH, "a+") as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)  # Released when the file is closed
+        state_file.seek(0)
+        try:
+            state = json.loads(state_file.read() or "{}")
+        except ValueError:
+            state = {}
+        # Uploads whose worker died can't finish, so they must not keep indexing paused
+        state["pids"] = [pid for pid in state.get("pids", []) if _pid_alive(pid)]
+        yield state
+        state_file.seek(0)
+        state_file.truncate()
+        json.dump(state, state_file)
+
+def _pause_indexing() -> bool:
+    """
+    Registers a bulk upload, pausing indexing if it is the only active one. Returns False if
+    the shared state is unavailable, in which case indexing is left alone.
+    """
+    try:
+        with _bulk_upload_state() as state:
+            if not state["pids"]:
+                # A threshold left behind by a crashed upload is still the one to restore
+                if state.get("threshold") is None:
+                    state["threshold"] = _get_indexing_threshold()
+                _set_indexing_threshold(0)
+            state["pids"].append(os.getpid())
+        return True
+    except OSError as e:
+        print(f"⚠️ Could not use bulk upload state '{BULK_UPLOAD_STATE_PATH}' ({e}); indexing stays on.")
+        return False
+
+def _resume_indexing():
+    """
+    Unregisters a bulk upload; the last one to finish restores the saved indexing threshold.
+    """
+    try:
+        with _bulk_upload_state() as state:
+            if os.getpid() in state["pids"]:
+                state["pids"].remove(os.getpid())
+            if not state["pids"]:
+                threshold = state.get("threshold")
+                _set_indexing_threshold(DEFAULT_INDEXING_THRESHOLD if threshold is None else threshold)
+                state["threshold"] = None
+    except OSError as e:
+        print(f"⚠️ Could not use bulk upload state '{BULK_UPLOAD_STATE_PATH}' ({e}); restoring indexing.")
+        _set_indexing_threshold(DEFAULT_INDEXING_THRESHOLD)
 
 # === Embed and Store Document Chunks ===
 def embed_and_store_chunks(documents: List[Document], session_id: str):
@@ -34,15 +309,31 @@ def embed_and_store_chunks(documents: List[Document], session_id: str):
     and stores them as points in the Qdrant knowledge base collection.
     Each chunk is associated with a session_id.
     """
-    points = []
     current_timestamp = str(int(time.time()))  # Use a Unix timestamp for when the document was uploaded
     
+    if not documents:
+        print("No chunks generated or provided to store.")
+        return
+    
+    # Chunks with identical text map to the same point ID anyway (e.g. repeated PDF headers),
+    # so encode and upload each distinct text only once
+    seen_texts = set()
+    unique_documents = []
+    for doc in documents:
+        if doc.text not in seen_texts:
+            seen_texts.add(doc.text)
+            unique_documents.append(doc)
+    documents = unique_documents
+    
+    # Encode all chunk texts in a single batched call instead of one encode() per chunk
+    texts = [doc.text for doc in documents]
+    embeddings = get_embeddings(texts)
+    
+    ids = []
+    payloads = []
     for doc in documents:
-        # Generate embedding for the chunk's text content
-        embedding = get_embedding(doc.text)
-        
         # Create payload for Qdrant, including chunk details and session ID
-        payload = {
+        payloads.append({
             "chunk_id": doc.chunk_id,
             "text": doc.text,
             "metadata": doc.metadata,  # Preserve original metadata from document_loader
@@ -50,26 +341,40 @@ def embed_and_store_chunks(documents: List[Document], session_id: str):
             "upload_timestamp": current_timestamp,
             "file_type": doc.metadata.get("file_type", "unknown"),  # Get file_type from metadata
             "source": doc.metadata.get("source", "unknown")  # Get source from metadata
-        }
-        
-        points.append(
-            PointStruct(
-                id=str(uuid.uuid4()),  # Assign a unique ID for each Qdrant point
-                vector=embedding,
-                payload=payload
-            )
-        )
+        })
+        # Same text in the same session maps to the same point, so re-uploads don't duplicate chunks
+        ids.append(content_point_id(session_id, doc.text))
     
-    # Perform the upsert operation to Qdrant if there are points to store
-    if points:
-        qdrant_client.upsert(
-            collection_name=KB_COLLECTION,
-            wait=True,  # Wait for the operation to complete
-            points=points
-        )
-        print(f"Stored {len(points)} chunks for session '{session_id}' into '{KB_COLLECTION}'.")
-    else:
-        print("No chunks generated or provided to store.")
+    # Very large uploads: pause HNSW building so the graph is built once afterwards,
+    # instead of being restructured while every batch arrives
+    pause_indexing = len(documents) >= BULK_INDEXING_MIN_POINTS and _pause_indexing()
+    try:
+        if len(documents) >= PARALLEL_UPLOAD_MIN_POINTS:
+            # Large uploads are pushed from several worker processes, never more than there are batches
+            qdrant_client.upload_collection(
+                collection_name=KB_COLLECTION,
+                vectors=embeddings,
+                payload=payloads,
+                ids=ids,
+                batch_size=UPSERT_BATCH_SIZE,
+                parallel=min(MAX_UPLOAD_WORKERS, os.cpu_count() or 1, math.ceil(len(documents) / UPSERT_BATCH_SIZE)),
+                wait=True  # Wait so the chunks are searchable as soon as the upload returns
+            )
+        else:
+            # Small uploads: upsert over the shared client channel; upload_collection would open
+            # a new gRPC channel (and TLS handshake) for every call.
+            # A column-oriented Batch skips building and validating one PointStruct per chunk.
+            for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+                end = start + UPSERT_BATCH_SIZE
+                qdrant_client.upsert(
+                    collection_name=KB_COLLECTION,
+                    wait=True,  # Wait so the chunks are searchable as soon as the upload returns
+                    points=Batch(ids=ids[start:end], vectors=embeddings[start:end].tolist(), payloads=payloads[start:end])
+                )
+    finally:
+        if pause_indexing:
+            _resume_indexing()  # The last bulk upload to finish triggers a single optimization pass
+    print(f"Stored {len(documents)} chunks for session '{session_id}' into '{KB_COLLECTION}'.")
 
 # === Search Knowledge Base ===
 def search_knowledge_base(query_text: str, session_id: str, top_k: int = 5) -> str:
@@ -83,40 +388,77 @@ def search_knowledge_base(query_text: str, session_id: str, top_k: int = 5) -> s
     
     query_embedding = get_embedding(query_text)
     
-    # Construct a filter to ensure we only search within the current session's data
-    session_filter = Filter(
-        must=[
-            FieldCondition(
-                key="session_id",
-                match=MatchValue(value=session_id)
-            )
-        ]
-    )
+    # Filter to ensure we only search within the current session's data (cached per session)
+    session_filter = get_session_filter(session_id)
     
     try:
         # Perform the search in Qdrant with the query vector and session filter
-        search_result: List[ScrollResult] = qdrant_client.search(
+        search_result: List[ScoredPoint] = qdrant_client.query_points(
             collection_name=KB_COLLECTION,
-            query_vector=query_embedding,
+            query=query_embedding,
             query_filter=session_filter,  # Apply the session-specific filter
             limit=top_k,  # Number of top results to retrieve
-            with_payload=True  # Ensure payload (text and metadata) is returned
-        )
-        
-        context_chunks = []
-        for hit in search_result:
-            # Extract the text content from the payload of each relevant hit
-            if hit.payload and 'text' in hit.payload:
-                context_chunks.append(hit.payload['text'])
-            # print(f"  Hit: {hit.payload.get('text', '')[:50]}... (Score: {hit.score})")  # Debugging line
+            with_payload=KB_SEARCH_PAYLOAD_FIELDS,  # Only return the payload fields we use
+            with_vectors=False,  # Never send the stored vectors back
+            search_params=KB_SEARCH_PARAMS  # Search int8 vectors, rescore with the originals
+        ).points
         
-        if context_chunks:
-            # Join relevant chunks into a single string to provide to the LLM
-            return "\n\n".join(context_chunks)
-        else:
+        context = _join_hit_texts(search_result)
+        if not context:
             print(f"No relevant context found in KB for session '{session_id}' and query: '{query_text}'")
-            return ""  # No relevant context found for this session
+        return context
             
     except Exception as e:
         print(f"Error during knowledge base search for session '{session_id}': {e}")
         return ""  # Return empty string on error
+
+# === Search Knowledge Base with Several Queries ===
+def search_knowledge_base_many(queries: List[str], session_id: str, top_k: int = 5) -> List[str]:
+    """
+    Searches the knowledge base for several queries at once (e.g. multi-query expansion).
+    All queries are embedded in one batched encode call and sent to Qdrant in a single
+    query_batch_points request. Returns one context string per query, in input order.
+    """
+    contexts = [""] * len(queries)
+    # Keep the positions of non-empty queries so results can be mapped back
+    positions = [i for i, query in enumerate(queries) if query.strip()]
+    if not positions:
+        return contexts
+    
+    query_embeddings = get_embeddings([queries[i] for i in positions])
+    session_filter = get_session_filter(session_id)
+    requests = [
+        QueryRequest(
+            query=embedding.tolist(),
+            filter=session_filter,
+            limit=top_k,
+            with_payload=KB_SEARCH_PAYLOAD_FIELDS,
+            with_vector=False,
+            params=KB_SEARCH_PARAMS
+        )
+        for embedding in query_embeddings
+    ]
+    
+    try:
+        responses = qdrant_client.query_batch_points(
+            collection_name=KB_COLLECTION,
+            requests=requests
+        )
+        for i, response in zip(positions, responses):
+            contexts[i] = _join_hit_texts(response.points)
+    except Exception as e:
+        print(f"Error during batched knowledge base search for session '{session_id}': {e}")
+    return contexts
+
+def _join_hit_texts(hits: List[ScoredPoint]) -> str:
+    """
+    Joins the text payloads of search hits into a single context string for the LLM.
+    """
+    context_chunks = []
+    for hit in hits:
+        # Extract the text content from the payload of each relevant hit
+        if hit.payload and 'text' in hit.payload:
+            context_chunks.append(hit.payload['text'])
+        # print(f"  Hit: {hit.payload.get('text', '')[:50]}... (Score: {hit.score})")  # Debugging line
+    # Join relevant chunks into a single string to provide to the LLM
+    return "\n\n".join(context_chunks)
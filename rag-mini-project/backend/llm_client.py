@@ -1,22 +1,19 @@
 # backend/llm_client.py
 
 import os
-from openai import OpenAI
+from typing import List, Dict
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
 api_key = os.getenv("GROQ_API_KEY")
-client = OpenAI(api_key=api_key, base_url="https://api.groq.com/openai/v1")
+client = AsyncOpenAI(api_key=api_key, base_url="https://api.groq.com/openai/v1")
 model_name = "llama3-70b-8192" # Or 'mixtral-8x7b-32768', 'gemma-7b-it' etc.
 
-def stream_llm_response(prompt: str):
-    """
-    Streams a response from the LLM based on the given prompt.
-    The system message is defined here to enforce the Mario persona and RAG rules.
-    """
-    # Enhanced system message for a more dynamic and interactive Mario
-    system_message = """You are Mario, a super helpful, friendly, and engaging AI assistant!
+# Enhanced system message for a more dynamic and interactive Mario.
+# Built once at import; it enforces the Mario persona and RAG rules for every request.
+SYSTEM_PROMPT = """You are Mario, a super helpful, friendly, and engaging AI assistant!
     You love to chat and make interactions fun, using Mario-esque phrases and tone.
     You're an expert at finding answers, but *only* from the knowledge you have.
 
@@ -39,16 +36,19 @@ def stream_llm_response(prompt: str):
     Let's go! I'm ready to help you explore the Mushroom Kingdom of knowledge!
     """
 
-    messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": prompt} # The 'prompt' argument already contains KB context, chat history, and user question
-    ]
+async def stream_llm_response(context_messages: List[Dict[str, str]]):
+    """
+    Streams a response from the LLM for the given chat messages (async generator of chunks).
+    The Mario system prompt is prepended here; callers pass the context and question
+    messages, so large context strings are sent as-is without being re-concatenated.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, *context_messages]
 
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=model_name,
         messages=messages,
         stream=True
     )
-    # Yield each chunk from the LLM response
-    for chunk in response:
+    # Yield each chunk from the LLM response without blocking the event loop
+    async for chunk in response:
         yield chunk
\ No newline at end of file
@@ -1,18 +1,31 @@
 # main.py
 from fastapi import FastAPI, File, UploadFile, Form, Query
 from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
 import uuid # <<< MAKE SURE THIS LINE IS PRESENT AND AT THE TOP!
+import time
+import asyncio
 
 # Import backend utilities
 from backend.embed_utils import embed_and_store_chunks, search_knowledge_base
 from backend.document_loader import extract_text # This will use your chunker internally
-from backend.chat_history import store_chat_turn, retrieve_chat_context
+from backend.chat_history import store_chat_turn, retrieve_chat_context, next_turn_number
 from backend.llm_client import stream_llm_response
 from backend.session_utils import delete_session_data # For clearing session data
 
 app = FastAPI()
 
+# Fixed parts of the context messages sent to the LLM, built once at import
+CHAT_HISTORY_HEADER = "Chat History:\n"
+KB_CONTEXT_HEADER = "Knowledge Base Context:\n"
+NO_CHAT_HISTORY = "No prior chat history for this session."
+NO_KB_CONTEXT = "No relevant knowledge base context found for this question. If you want me to learn, upload a document!"
+
+# Streamed tokens are sent once this many characters are buffered or this much time has passed
+STREAM_FLUSH_CHARS = 256
+STREAM_FLUSH_SECONDS = 0.05
+
 # Add root endpoint to eliminate 404 errors
 @app.get("/")
 async def root():
@@ -48,57 +61,54 @@ async def chat(question: str, session_id: str = ""):
         print(f"Warning: No session_id provided for chat. Generated new one: {session_id}")
     
     # --- Retrieve Context ---
-    # Search the knowledge base for relevant documents based on the current question and session
-    kb_context = search_knowledge_base(question, session_id=session_id)
-    
-    # Retrieve previous chat turns for conversational context
-    chat_context = retrieve_chat_context(session_id, question)
-    
-    # --- Construct LLM Prompt ---
-    # The prompt structure guides the LLM on how to use the provided context
-    prompt_for_llm = f"""
-    You are Mario, a super helpful, friendly, and engaging AI assistant!
-    You love to chat and make interactions fun, using Mario-esque phrases and tone.
-    You're an expert at finding answers, but *only* from the knowledge you have.
-    
-    Here's the information I have for you:
+    # Both lookups are independent Qdrant round-trips, so run them concurrently in the threadpool:
+    # search the knowledge base for relevant documents based on the current question and session,
+    # and retrieve previous chat turns for conversational context
+    kb_context, chat_context = await asyncio.gather(
+        run_in_threadpool(search_knowledge_base, question, session_id=session_id),
+        run_in_threadpool(retrieve_chat_context, session_id, question)
+    )
     
-    Chat History:
-    {chat_context if chat_context else "No prior chat history for this session."}
-    
-    Knowledge Base Context:
-    {kb_context if kb_context else "No relevant knowledge base context found for this question. If you want me to learn, upload a document!"}
-    
-    User's Question:
-    {question}
-    
-    Please provide a helpful and friendly response, using the provided context if relevant.
-    If the answer isn't in the provided context, please politely say so and encourage the user
-    to provide more information or upload a document, using Mario-themed language.
-    """
+    # --- Construct LLM Messages ---
+    # The Mario persona and rules live in the LLM client's system prompt, the only system message.
+    # Retrieved context is untrusted (uploaded documents, past chat), so it goes in user messages where
+    # it can't override those rules; separate messages also avoid re-copying it into one prompt
+    messages_for_llm = [
+        {"role": "user", "content": CHAT_HISTORY_HEADER + (chat_context or NO_CHAT_HISTORY)},
+        {"role": "user", "content": KB_CONTEXT_HEADER + (kb_context or NO_KB_CONTEXT)},
+        {"role": "user", "content": question},
+    ]
     
     # --- Stream LLM Response ---
     async def stream_response():
-        # Determine the turn number for storing chat history
-        # This calculates approximate turn number based on how many "lines" are in chat_context
-        # It assumes each user/assistant turn is one line in the formatted chat_context
-        turn_number = (len(chat_context.split("\n")) // 2) + 1 if chat_context else 1
+        # Determine the turn number for storing chat history (an exact count of the session's
+        # stored messages via the session_id payload index)
+        turn_number = await run_in_threadpool(next_turn_number, session_id)
         
-        # Store the user's question in chat history immediately
-        store_chat_turn(session_id, "user", question, turn_number)
+        # Store the user's question in chat history immediately (in a thread, it's a blocking Qdrant call)
+        await run_in_threadpool(store_chat_turn, session_id, "user", question, turn_number)
         
         full_response = ""
+        buffer = ""
+        last_flush = time.monotonic()
         # Call the LLM client to get a streaming response
-        for chunk in stream_llm_response(prompt=prompt_for_llm):
+        async for chunk in stream_llm_response(messages_for_llm):
             if chunk.choices and len(chunk.choices) > 0:
                 choice = chunk.choices[0]  # Get the first choice
                 if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content:
                     token = choice.delta.content
                     full_response += token
-                    yield token # Yield each token as it arrives
+                    buffer += token
+                    # Coalesce tokens into larger pieces instead of sending one ASGI message per token
+                    if len(buffer) >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush >= STREAM_FLUSH_SECONDS:
+                        yield buffer
+                        buffer = ""
+                        last_flush = time.monotonic()
+        if buffer:
+            yield buffer
         
         # Store the full assistant response in chat history once complete
-        store_chat_turn(session_id, "assistant", full_response, turn_number)
+        await run_in_threadpool(store_chat_turn, session_id, "assistant", full_response, turn_number)
     
     return StreamingResponse(stream_response(), media_type="text/plain")
 
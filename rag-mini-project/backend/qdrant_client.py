@@ -1,8 +1,17 @@
 # backend/qdrant_client.py
 
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PayloadSchemaType, FilterSelector, Filter, CollectionStatus
+from qdrant_client.models import (
+    VectorParams, Distance, PayloadSchemaType, FilterSelector, Filter, CollectionStatus,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, FieldCondition, MatchValue, HnswConfigDiff,
+)
 import os
+import fcntl  # File lock so only one worker runs the startup setup
+import multiprocessing  # Tells uvicorn-spawned workers apart from a single-process server
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,27 +22,51 @@ QDRANT_HOST = os.getenv(
     "https://9485db48-8672-469a-a917-41a4ebbfd533.us-east4-0.gcp.cloud.qdrant.io"  # Your cloud URL
 )
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")  # Only needed for cloud Qdrant
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))  # Qdrant Cloud serves gRPC on 6334
 
 # === Collection Names ===
 KB_COLLECTION = "rag_collection"  # For document embeddings
-CHAT_HISTORY_COLLECTION = "chat_history_collection"  # For chat messages
+# Chat turns are stored as payload-only points (no vectors), so this collection is created
+# without a vector config. The name differs from the old 384-dim "chat_history_collection".
+CHAT_HISTORY_COLLECTION = "chat_history_payload_collection"  # For chat messages
+LEGACY_CHAT_HISTORY_COLLECTION = "chat_history_collection"  # Old vector-based chat store, dropped at startup
+
+# === Vector Quantization ===
+# int8 scalar quantization keeps a compact copy of each vector in RAM for fast search,
+# while the original float32 vector stays on disk for rescoring.
+KB_QUANTIZATION_CONFIG = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(
+        type=ScalarType.INT8,
+        quantile=0.99,
+        always_ram=True,
+    )
+)
+
+# === HNSW Graph Settings ===
+# m: links per node, ef_construct: candidate list size while building the graph
+KB_HNSW_CONFIG = HnswConfigDiff(m=16, ef_construct=128)
 
 # === Qdrant Client Initialization ===
+# Module-level singleton: every backend module imports this client, so the process shares
+# one gRPC (HTTP/2 multiplexed) channel across requests.
 qdrant_client = QdrantClient(
     url=QDRANT_HOST,
     api_key=QDRANT_API_KEY,
-    prefer_grpc=False,  # Set to True for gRPC, False for REST
-    timeout=30,  # Increased timeout for potentially slow operations
+    prefer_grpc=True,  # gRPC sends vectors as packed protobuf floats instead of JSON text
+    grpc_port=QDRANT_GRPC_PORT,
+    timeout=60,  # Increased timeout for potentially slow operations
     check_compatibility=False,  # Skip version check to avoid warnings
 )
 
 print("✅ Connected to Qdrant Cloud")
 
 # === Collection Creation and Management ===
-def ensure_collection_exists(name: str, vector_size: int = 384):
+def ensure_collection_exists(name: str, vector_size: Optional[int] = 384, quantization_config=None, hnsw_config=None):
     """
     Guarantees that a collection exists; creates it only if it is missing.
     Uses create_collection (non-destructive) so no delete permission is needed.
+    Pass vector_size=None to create a payload-only collection without vectors.
+    quantization_config/hnsw_config are only applied when the collection is created.
     """
     try:
         qdrant_client.get_collection(collection_name=name)
@@ -41,17 +74,53 @@ def ensure_collection_exists(name: str, vector_size: int = 384):
     except Exception:
         print(f"🆕 Creating collection: {name}")
         try:
-            qdrant_client.create_collection(
-                collection_name=name,
-                vectors_config=VectorParams(
+            if vector_size is None:
+                vectors_config = {}  # No vectors: points carry payload only
+            else:
+                vectors_config = VectorParams(
                     size=vector_size,
                     distance=Distance.COSINE,
-                ),
+                )
+            qdrant_client.create_collection(
+                collection_name=name,
+                vectors_config=vectors_config,
+                quantization_config=quantization_config,
+                hnsw_config=hnsw_config,
             )
             print(f"🎉 Collection '{name}' created successfully!")
         except Exception as e:
             print(f"❌ Failed to create collection '{name}': {e}")
 
+# === Legacy Collection Cleanup ===
+def drop_collection_if_exists(name: str):
+    """
+    Deletes a collection that is no longer used, if it still exists.
+    After the first successful run this is a single existence check.
+    """
+    try:
+        if not qdrant_client.collection_exists(collection_name=name):
+            return
+        qdrant_client.delete_collection(collection_name=name)
+        print(f"🗑️ Dropped unused collection '{name}'.")
+    except Exception as e:
+        print(f"⚠️ Could not drop unused collection '{name}': {e}")
+
+# === Vector Index Settings Helper ===
+def ensure_vector_index_config(name: str, quantization_config=KB_QUANTIZATION_CONFIG, hnsw_config=KB_HNSW_CONFIG):
+    """
+    Applies quantization and HNSW settings to an existing collection.
+    Safe to call repeatedly; Qdrant ignores it if the config is unchanged.
+    """
+    try:
+        qdrant_client.update_collection(
+            collection_name=name,
+            quantization_config=quantization_config,
+            hnsw_config=hnsw_config,
+        )
+        print(f"🗜️ Quantization and HNSW settings applied to '{name}'")
+    except Exception as e:
+        print(f"⚠️ Could not apply quantization/HNSW settings to '{name}': {e}")
+
 # === Payload Indexing Helper ===
 def create_index_if_needed(collection: str, field_name: str, schema_type: str):
     """
@@ -71,10 +140,36 @@ def create_index_if_needed(collection: str, field_name: str, schema_type: str):
         else:
             print(f"⚠️ Could not create index '{field_name}' on '{collection}': {e}")
 
+# === Session Filter Helper ===
+@lru_cache(maxsize=2048)
+def get_session_filter(session_id: str) -> Filter:
+    """
+    Returns a Filter matching points of one session. The Filter is built once per session
+    and shared between callers, so treat it as read-only.
+    """
+    return Filter(
+        must=[
+            FieldCondition(
+                key="session_id",
+                match=MatchValue(value=session_id)
+            )
+        ]
+    )
+
+# === Point ID Helper ===
+def content_point_id(*parts: str) -> int:
+    """
+    Derives a deterministic unsigned 64-bit point ID from the given strings.
+    Integer IDs are smaller than UUID strings, and re-upserting the same content
+    with the same parts overwrites the existing point instead of duplicating it.
+    """
+    key = "\x00".join(parts).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
 # === Data Cleanup Utility (for development/testing) ===
-def clean_collections():
+def clean_collections() -> bool:
     """
-    Deletes ALL points from both collections.
+    Deletes ALL points from both collections. Returns True if both deletes succeeded.
     Call it manually; do NOT run automatically in production.
     """
     print("🧹 Cleaning old data from all collections...")
@@ -95,28 +190,105 @@ def clean_collections():
         )
         print(f"🗑️ All data cleaned from '{CHAT_HISTORY_COLLECTION}'.")
         print("🗑️ All old data cleaned from collections successfully.")
+        return True
         
     except Exception as e:
         print(f"❌ Error during collection cleanup: {e}")
+        return False
+
+# Payload indexes as (collection, field, schema type). session_id is filtered on by every
+# search/scroll/delete, and turn_number orders chat history; without these Qdrant full-scans.
+PAYLOAD_INDEXES = [
+    # Chat history: filtering by session and ordering by turn
+    (CHAT_HISTORY_COLLECTION, "session_id", "keyword"),
+    (CHAT_HISTORY_COLLECTION, "turn_number", "integer"),
+    (CHAT_HISTORY_COLLECTION, "timestamp", "keyword"),  # Useful for sorting/filtering by time
+    # Knowledge base: filtering documents
+    (KB_COLLECTION, "session_id", "keyword"),
+    (KB_COLLECTION, "upload_timestamp", "keyword"),
+    (KB_COLLECTION, "file_type", "keyword"),
+    (KB_COLLECTION, "source", "keyword"),  # Index source if you use it for filtering
+]
+
+# === Startup Setup ===
+def setup_collections():
+    """
+    Ensures both collections exist with the expected vector settings and payload indexes.
+    Every step is idempotent, so it is safe to run in every worker.
+    """
+    # Each step is an independent network round-trip, so they are issued concurrently over the
+    # shared client: wall-clock is roughly one round-trip per phase instead of one per call
+    with ThreadPoolExecutor(max_workers=len(PAYLOAD_INDEXES) + 2) as executor:
+        # Phase 1: collections (indexes and settings need them to exist)
+        list(executor.map(lambda args: ensure_collection_exists(**args), [
+            dict(name=KB_COLLECTION, quantization_config=KB_QUANTIZATION_CONFIG, hnsw_config=KB_HNSW_CONFIG),
+            dict(name=CHAT_HISTORY_COLLECTION, vector_size=None),
+        ]))
+
+        # Phase 2: store KB vectors as int8 for search (original float32 vectors are kept for
+        # rescoring), bring older collections up to date, create the payload indexes, and drop
+        # the chat history collection that was replaced by the payload-only one
+        futures = [
+            executor.submit(ensure_vector_index_config, KB_COLLECTION),
+            executor.submit(drop_collection_if_exists, LEGACY_CHAT_HISTORY_COLLECTION),
+        ]
+        futures += [
+            executor.submit(create_index_if_needed, collection, field_name, schema_type)
+            for collection, field_name, schema_type in PAYLOAD_INDEXES
+        ]
+        for future in futures:
+            future.result()
+
+# === Data wipe is opt-in ===
+# Wiping deletes all data from Qdrant. It's useful for debugging only; set QDRANT_WIPE_ON_START=1
+# to wipe once per server start. Workers that start later (or are restarted after a crash) must
+# not wipe data the other workers are already serving, so the wipe is recorded per server start.
+WIPE_ON_START = os.getenv("QDRANT_WIPE_ON_START") == "1"
+
+def _server_start_id() -> str:
+    """
+    Identifies the current server start as "pid:start time" of the server process.
+    uvicorn spawns its workers (and the --reload child) from the server process, so they all
+    share its id; a single-process server is the server process itself.
+    """
+    server_pid = os.getppid() if multiprocessing.parent_process() is not None else os.getpid()
+    try:
+        with open(f"/proc/{server_pid}/stat") as stat_file:
+            start_time = stat_file.read().rsplit(")", 1)[1].split()[19]  # Field 22: starttime
+    except (OSError, IndexError):
+        start_time = "unknown"
+    return f"{server_pid}:{start_time}"
+
+# Lock file shared by all uvicorn workers: they run the setup one after another instead of
+# racing to create the same collections and indexes. It records the server start that last wiped.
+SETUP_LOCK_PATH = os.getenv("QDRANT_SETUP_LOCK", "/tmp/qdrant_setup.lock")
+
+def run_startup_setup():
+    """
+    Runs setup_collections() while holding an exclusive file lock, so concurrent workers
+    don't race. Every setup step is idempotent, so each worker and every restart runs it again.
+    With QDRANT_WIPE_ON_START=1, only the first worker of a server start wipes the data.
+    Falls back to running setup unguarded (and never wiping) if the lock file can't be used.
+    """
+    try:
+        with open(SETUP_LOCK_PATH, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            setup_collections()
+            if WIPE_ON_START:
+                start_id = _server_start_id()
+                lock_file.seek(0)
+                if lock_file.read().strip() == start_id:
+                    print("ℹ️ Data was already wiped for this server start; skipping the wipe.")
+                elif clean_collections():
+                    # Recorded only after a successful wipe, so a failed one is retried by the next worker
+                    lock_file.seek(0)
+                    lock_file.truncate()
+                    lock_file.write(start_id)
+    except OSError as e:
+        print(f"⚠️ Could not use setup lock '{SETUP_LOCK_PATH}' ({e}); running setup without it.")
+        setup_collections()
+        if WIPE_ON_START:
+            print("⚠️ Skipping QDRANT_WIPE_ON_START: without the lock, workers can't agree on a single wipe.")
 
 # === Initial Setup when this module is imported ===
-# Ensure collections exist and create necessary payload indexes
-ensure_collection_exists(KB_COLLECTION)
-ensure_collection_exists(CHAT_HISTORY_COLLECTION)
-
-# Create indexes for filtering and ordering chat history
-create_index_if_needed(CHAT_HISTORY_COLLECTION, "session_id", "keyword")
-create_index_if_needed(CHAT_HISTORY_COLLECTION, "turn_number", "integer")
-create_index_if_needed(CHAT_HISTORY_COLLECTION, "timestamp", "keyword")  # Useful for sorting/filtering by time
-
-# Create indexes for filtering knowledge base documents
-create_index_if_needed(KB_COLLECTION, "session_id", "keyword")
-create_index_if_needed(KB_COLLECTION, "upload_timestamp", "keyword")
-create_index_if_needed(KB_COLLECTION, "file_type", "keyword")
-create_index_if_needed(KB_COLLECTION, "source", "keyword")  # Index source if you use it for filtering
-
-# === IMPORTANT: Data wipe is now commented out ===
-# This line will wipe all your data from Qdrant EVERY TIME the backend starts.
-# It's useful for initial setup and debugging, but comment it out for persistence.
-# Uncomment ONLY when you need to clear data manually:
-# clean_collections()
+run_startup_setup()
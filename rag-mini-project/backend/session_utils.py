@@ -1,6 +1,7 @@
 # backend/session_utils.py
 
 from backend.qdrant_client import qdrant_client, KB_COLLECTION, CHAT_HISTORY_COLLECTION
+from backend.chat_history import clear_turn_cache
 # Import FilterSelector from qdrant_client.models to correctly structure delete requests
 from qdrant_client.models import Filter, FieldCondition, MatchValue, FilterSelector
 
@@ -29,6 +30,7 @@ def delete_session_data(session_id: str) -> bool:
             # points_selector must be a PointsSelector object (like FilterSelector)
             points_selector=FilterSelector(filter=session_filter_condition)
         )
+        clear_turn_cache(session_id)
         print(f"🗑️ Deleted chat history for session '{session_id}'.")
 
         # Delete points from the knowledge base (RAG) collection
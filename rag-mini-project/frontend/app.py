@@ -35,6 +35,10 @@ if "session_reset" not in st.session_state:
 if "uploader_key" not in st.session_state:
     st.session_state.uploader_key = 0
 
+# Persistent HTTP session so uploads and chats reuse one keep-alive connection to the backend
+if "http" not in st.session_state:
+    st.session_state.http = requests.Session()
+
 # --- Custom Function to Handle "End Chat" ---
 def handle_end_chat():
     current_session_id = st.session_state.session_id
@@ -42,7 +46,7 @@ def handle_end_chat():
     # Send a request to the FastAPI backend to delete session-specific data from Qdrant
     try:
         with st.spinner(f"🧹 Clearing data for session '{current_session_id}' from database..."):
-            response = requests.post(f"{BACKEND_URL}/end_session?session_id={current_session_id}")
+            response = st.session_state.http.post(f"{BACKEND_URL}/end_session?session_id={current_session_id}")
         
         if response.status_code == 200:
             st.success(f"✅ Data for session '{current_session_id}' cleared from database. Wahoo!")
@@ -81,12 +85,16 @@ if uploaded_file:
     # This prevents redundant backend calls and duplicate display
     if uploaded_file.name not in st.session_state.uploaded_doc_names:
         with st.spinner(f"📄 Processing '{uploaded_file.name}'... Get ready for some power-ups!"):
+            # Send the file's MIME type so the backend sees the real content type. requests still
+            # reads the whole file into memory to build the multipart body. Rewind first so a
+            # rerun re-sends the file from the start.
+            uploaded_file.seek(0)
             files = {
-                "file": (uploaded_file.name, uploaded_file.getvalue())
+                "file": (uploaded_file.name, uploaded_file, uploaded_file.type)
             }
             data = {"session_id": st.session_state.session_id}
             try:
-                upload_response = requests.post(f"{BACKEND_URL}/upload_document", files=files, data=data)
+                upload_response = st.session_state.http.post(f"{BACKEND_URL}/upload_document", files=files, data=data)
                 if upload_response.status_code == 200:
                     st.success(f"✅ Document '{uploaded_file.name}' uploaded and processed. It's-a me, ready!")
                     # Add the document name to the session state for display
@@ -136,7 +144,7 @@ if question:
         with st.spinner("🤖 Mario is thinking... Wahoo!"):
             try:
                 # Make a GET request to the FastAPI /chat endpoint
-                response = requests.get(f"{BACKEND_URL}/chat", params={
+                response = st.session_state.http.get(f"{BACKEND_URL}/chat", params={
                     "question": question,
                     "session_id": st.session_state.session_id
                 }, stream=True, timeout=180) # Increased timeout for potentially longer LLM responses
@@ -145,16 +153,22 @@ if question:
                 decoder = codecs.getincrementaldecoder("utf-8")()
                 full_response = ""
                 placeholder = st.empty() # Placeholder for streaming text
+                last_update = 0.0
                 
-                for chunk in response.iter_content(chunk_size=1):
+                # chunk_size=None yields data as soon as it arrives from the socket, whatever its size
+                for chunk in response.iter_content(chunk_size=None):
                     if chunk:
                         token = decoder.decode(chunk)
                         full_response += token
-                        # Update the placeholder with the streamed text and a typing cursor
-                        placeholder.markdown(f"🍄 **Mario:** {full_response}▌") 
-                        time.sleep(0.02) # Small delay for typing effect
+                        # Update the placeholder with the streamed text and a typing cursor,
+                        # at most every 50ms to avoid re-rendering on every tiny chunk
+                        now = time.monotonic()
+                        if now - last_update >= 0.05:
+                            placeholder.markdown(f"🍄 **Mario:** {full_response}▌")
+                            last_update = now
                 
                 # Display the final, complete response
+                full_response += decoder.decode(b"", final=True)
                 placeholder.markdown(f"🍄 **Mario:** {full_response}")
                 st.session_state.chat_history.append({"role": "assistant", "content": full_response})
                 